@@ -0,0 +1,69 @@
+"""
+Замер времени холодного старта бота без сети.
+
+Каждый прогон - отдельный процесс python во временной папке:
+импорт main.py, создание Bot, загрузка кэша file_id и подготовка папки загрузок
+(то, что main() делает до polling).
+Скрипт завершается с кодом 1, если медиана дольше бюджета.
+
+    python bench_startup.py [прогонов] [бюджет_в_секундах]
+"""
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+RUNS = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+BUDGET = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PROBE = """
+import time
+t0 = time.perf_counter()
+import main
+t1 = time.perf_counter()
+main.bot = main.Bot(token="0:benchmark")
+main.file_cache.update(main.load_file_cache())
+main.reset_temp_folder()
+t2 = time.perf_counter()
+print(f"{t1 - t0:.4f} {t2 - t0:.4f}")
+"""
+
+def run_once(workdir):
+    env = {**os.environ, "PYTHONPATH": REPO_DIR, "BOT_TOKEN": "0:benchmark"}
+    proc = subprocess.run(
+        [sys.executable, "-c", PROBE], cwd=workdir, env=env,
+        capture_output=True, text=True, check=True
+    )
+    import_s, ready_s = map(float, proc.stdout.split()[-2:])
+    return import_s, ready_s
+
+def fill_workdir(workdir):
+    # Большая старая папка downloads/ не должна влиять на время старта
+    os.makedirs(os.path.join(workdir, "downloads"))
+    for i in range(200):
+        with open(os.path.join(workdir, "downloads", f"track_{i}.m4a"), "wb") as f:
+            f.write(b"\0" * 1024)
+
+def main():
+    results = []
+    # Каждый прогон - в новой папке с заполненным downloads/, как при настоящем перезапуске
+    for _ in range(RUNS):
+        with tempfile.TemporaryDirectory() as workdir:
+            fill_workdir(workdir)
+            results.append(run_once(workdir))
+
+    imports = [r[0] for r in results]
+    ready = [r[1] for r in results]
+    print(f"Прогонов: {RUNS}")
+    print(f"Импорт main.py: медиана {statistics.median(imports) * 1000:.0f} мс, макс {max(imports) * 1000:.0f} мс")
+    print(f"До готовности к polling: медиана {statistics.median(ready) * 1000:.0f} мс, макс {max(ready) * 1000:.0f} мс")
+
+    if statistics.median(ready) > BUDGET:
+        print(f"❌ Медиана старта больше бюджета {BUDGET} с")
+        sys.exit(1)
+    print(f"✅ В пределах бюджета {BUDGET} с")
+
+if __name__ == "__main__":
+    main()
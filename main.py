@@ -1,3 +1,6 @@
+import time
+STARTED_AT = time.perf_counter()  # Отсчет времени старта для логов и /health
+
 import os
 import asyncio
 import logging
@@ -5,12 +8,24 @@ import shutil
 import subprocess
 import re
 import json
+import math
+import sqlite3
+import threading
+import glob
+import functools
+import contextvars
+import cProfile
+import pstats
+import io
+import uuid
+import sys
+import traceback
+from contextlib import contextmanager
 from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, F, types
 from aiogram.filters import Command
-from aiogram.types import InlineQueryResultArticle, InputTextMessageContent, FSInputFile, URLInputFile, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, BotCommand
-from ytmusicapi import YTMusic
+from aiogram.types import InlineQueryResultArticle, InputTextMessageContent, FSInputFile, URLInputFile, BufferedInputFile, InlineQueryResultsButton, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, BotCommand
 
 # Загрузка переменных из .env
 load_dotenv()
@@ -21,16 +36,96 @@ logger = logging.getLogger(__name__)
 
 # --- НАСТРОЙКИ ---
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-if not BOT_TOKEN:
-    logger.error("BOT_TOKEN не найден в переменных окружения или .env файле!")
-    exit(1)
 
 TEMP_FOLDER = "downloads"
 SUBS_FILE = "subscriptions.json"
-
-bot = Bot(token=BOT_TOKEN)
+CACHE_FILE = "file_cache.json"
+PLAYLIST_PROGRESS_FILE = "playlist_progress.json"
+RELEASES_FILE = "releases.json"
+RELEASES_KEEP = 200  # Сколько последних релизов помнить для кнопок уведомлений
+
+# Приватный чат/канал-хранилище: новые релизы заливаются туда один раз,
+# а подписчикам отправляются по file_id. Пусто - режим выключен.
+STORAGE_CHAT_ID = os.getenv("STORAGE_CHAT_ID")
+
+# Локальный каталог всего, что когда-либо приходило из YouTube Music
+CATALOG_DB = "catalog.db"
+INLINE_LOCAL_MIN = 5          # Сколько локальных результатов достаточно, чтобы не ждать YouTube
+INLINE_UPSTREAM_TIMEOUT = 4   # Секунд ждем YouTube, если локально почти ничего нет
+CATALOG_REFRESH_INTERVAL = 600  # Как часто обновлять один и тот же запрос в фоне
+CATALOG_REFRESH_DELAY = 2       # Фоновое обновление - только если пользователь перестал печатать
+CATALOG_REFRESH_MAX = 1000      # Сколько запросов помнить в catalog_refreshed
+
+# Трассировка: спаны пишутся JSON-строками в логгер "trace" (и в файл, если задан)
+TRACE_LOG_FILE = os.getenv("TRACE_LOG_FILE")
+# Telegram ID администраторов через запятую (для /profile)
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+
+# Статистика запросов и прогрев кэша
+STATS_HALF_LIFE = int(os.getenv("STATS_HALF_LIFE", 24 * 3600))  # Период полураспада счетчиков, сек
+WARM_INTERVAL = 3600               # Как часто пересчитывать топ и прогревать кэш
+WARM_TOP_TRACKS = int(os.getenv("WARM_TOP_TRACKS", 50))  # Сколько популярных треков держать с file_id
+WARM_TOP_QUERIES = int(os.getenv("WARM_TOP_QUERIES", 20))
+# Часы низкой нагрузки (по локальному времени сервера), например "3-7"
+WARM_HOURS = tuple(int(h) for h in os.getenv("WARM_HOURS", "3-7").split("-"))
+
+# Плейлисты: размер страницы, лимит треков за один запуск и дневная квота на пользователя
+PLAYLIST_PAGE_SIZE = int(os.getenv("PLAYLIST_PAGE_SIZE", 25))
+PLAYLIST_MAX_TRACKS = int(os.getenv("PLAYLIST_MAX_TRACKS", 100))
+PLAYLIST_DAILY_QUOTA = int(os.getenv("PLAYLIST_DAILY_QUOTA", 300))
+
+# Лимиты запросов (token bucket): категория -> [емкость, пополнение за PERIOD секунд].
+# search - поиск командами, inline - inline-поиск (Telegram шлет запрос на каждое нажатие клавиши,
+# поэтому бюджет больше), download - один трек/видео, bulk - альбомы и плейлисты целиком.
+# Переопределяются и дополняются новыми тарифами через JSON из RATE_LIMITS,
+# например {"vip": {"bulk": [5, 10, 3600]}, "partner": {"bulk": [20, 20, 3600]}}.
+# Недостающие категории нового тарифа берутся из default.
+RATE_LIMITS = {
+    "default": {"search": [20, 20, 60], "inline": [60, 60, 60], "download": [10, 10, 60], "bulk": [2, 3, 3600]},
+    "vip": {"search": [60, 60, 60], "inline": [180, 180, 60], "download": [30, 30, 60], "bulk": [5, 10, 3600]},
+    # Общий бюджет группового чата (в личке совпадает с пользователем и не проверяется;
+    # у inline-запросов чата нет)
+    "chat": {"search": [60, 60, 60], "inline": [180, 180, 60], "download": [30, 30, 60], "bulk": [5, 5, 3600]},
+}
+for _tier, _limits in json.loads(os.getenv("RATE_LIMITS", "{}")).items():
+    RATE_LIMITS[_tier] = {**RATE_LIMITS["default"], **RATE_LIMITS.get(_tier, {}), **_limits}
+# Тариф пользователя: RATE_TIERS - JSON {"user_id": "тариф"}, VIP_IDS - сокращение для "vip"
+VIP_IDS = {int(x) for x in os.getenv("VIP_IDS", "").split(",") if x.strip()}
+RATE_TIERS = {int(uid): tier for uid, tier in json.loads(os.getenv("RATE_TIERS", "{}")).items()}
+RATE_TIERS.update({uid: "vip" for uid in VIP_IDS})
+
+# Порт HTTP-эндпоинтов /health и /ready. Пусто - не запускать.
+HEALTH_PORT = os.getenv("HEALTH_PORT")
+
+class LazyYTMusic:
+    """
+    Клиент YouTube Music создается при первом вызове метода, а не при импорте.
+    Вызовы идут через пул потоков, поэтому и сборка клиента не блокирует event loop.
+    """
+    def __init__(self):
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self._client is not None
+
+    def get(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from ytmusicapi import YTMusic
+                    self._client = YTMusic()
+        return self._client
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            return getattr(self.get(), name)(*args, **kwargs)
+        return call
+
+bot = None  # Создается в main(), когда известен токен
 dp = Dispatcher()
-ytmusic = YTMusic()  # Инициализация API YouTube Music
+ytmusic = LazyYTMusic()
 
 # Загрузка/сохранение подписок
 def load_subs():
@@ -43,12 +138,150 @@ def save_subs(data):
     with open(SUBS_FILE, 'w', encoding='utf-8') as f:
         json.dump(data, f, ensure_ascii=False, indent=4)
 
-if os.path.exists(TEMP_FOLDER):
-    shutil.rmtree(TEMP_FOLDER)
-os.makedirs(TEMP_FOLDER, exist_ok=True)
+# Кэш file_id уже отправленных треков (video_id -> file_id)
+def load_file_cache():
+    if os.path.exists(CACHE_FILE):
+        try:
+            with open(CACHE_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except json.JSONDecodeError as e:
+            # Кэш - не критичные данные: с поврежденным файлом бот все равно должен стартовать
+            logger.error(f"{CACHE_FILE} поврежден ({e}), кэш file_id начинается с нуля")
+    return {}
+
+def save_file_cache(data):
+    # Через временный файл и os.replace: при падении посреди записи старый файл останется целым
+    tmp_path = f"{CACHE_FILE}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, CACHE_FILE)
+
+file_cache = {}  # Заполняется в main() из CACHE_FILE, чтобы импорт не читал диск
+file_cache_save_pending = False
+
+def flush_file_cache():
+    global file_cache_save_pending
+    file_cache_save_pending = False
+    try:
+        save_file_cache(dict(file_cache))
+    except Exception as e:
+        logger.error(f"Ошибка сохранения кэша file_id: {e}")
+
+def schedule_file_cache_save():
+    """Сохраняет кэш в потоке каталога; несколько изменений подряд сливаются в одну запись."""
+    global file_cache_save_pending
+    if not file_cache_save_pending:
+        file_cache_save_pending = True
+        catalog_executor.submit(flush_file_cache)
+
+def remember_file_id(video_id, sent_message):
+    """Запоминает file_id отправленного аудио, чтобы не скачивать трек повторно."""
+    if sent_message and sent_message.audio:
+        file_cache[video_id] = sent_message.audio.file_id
+        schedule_file_cache_save()
+
+# Прогресс загрузки плейлистов ("chat_id:playlist_id" -> индекс следующего трека)
+def load_playlist_progress():
+    if os.path.exists(PLAYLIST_PROGRESS_FILE):
+        with open(PLAYLIST_PROGRESS_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return {}
+
+def save_playlist_progress(data):
+    with open(PLAYLIST_PROGRESS_FILE, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+
+# Треки новых релизов (browseId -> {"thumb", "tracks"}) для кнопки "Скачать" в уведомлениях
+def load_releases():
+    if os.path.exists(RELEASES_FILE):
+        with open(RELEASES_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return {}
+
+def save_releases(data):
+    with open(RELEASES_FILE, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+
+def reset_temp_folder():
+    """
+    Освобождает TEMP_FOLDER мгновенно: старая папка переименовывается,
+    а удаляется уже в фоне, чтобы большой downloads/ не задерживал запуск.
+    """
+    stale = None
+    if os.path.exists(TEMP_FOLDER):
+        # Имя уникально даже для нескольких перезапусков в одну секунду
+        stale = f"{TEMP_FOLDER}.old-{time.time_ns()}-{os.getpid()}"
+        os.rename(TEMP_FOLDER, stale)
+    os.makedirs(TEMP_FOLDER, exist_ok=True)
+    return stale
+
+def cleanup_stale_temp():
+    """Удаляет старые папки загрузок (в том числе оставшиеся после падений)."""
+    for stale in glob.glob(f"{TEMP_FOLDER}.old-*"):
+        shutil.rmtree(stale, ignore_errors=True)
+    startup_state["temp_cleanup"] = "done"
 
 # Пул потоков
 executor = ThreadPoolExecutor(max_workers=4)
+# Отдельный поток для локального каталога: быстрые запросы к SQLite не ждут воркеров, занятых yt-dlp
+catalog_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="catalog")
+
+# --- ТРАССИРОВКА ---
+
+trace_logger = logging.getLogger("trace")
+if TRACE_LOG_FILE:
+    trace_handler = logging.FileHandler(TRACE_LOG_FILE, encoding='utf-8')
+    trace_handler.setFormatter(logging.Formatter("%(message)s"))
+    trace_logger.addHandler(trace_handler)
+    trace_logger.propagate = False
+
+# trace_id текущего запроса: задается для каждого апдейта Telegram и наследуется задачами
+trace_id_var = contextvars.ContextVar("trace_id", default="-")
+
+def new_trace_id(prefix="bg"):
+    return f"{prefix}-{uuid.uuid4().hex[:12]}"
+
+@contextmanager
+def span(name, **attrs):
+    """
+    Замеряет участок кода и пишет его одной JSON-строкой.
+    В блоке можно дописывать атрибуты в возвращаемый словарь, ключ "error" помечает спан ошибочным.
+    """
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield attrs
+    except BaseException as e:
+        status = "error"
+        attrs["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        if "error" in attrs:
+            status = "error"
+        trace_logger.info(json.dumps({
+            "ts": round(time.time(), 3),
+            "trace_id": trace_id_var.get(),
+            "span": name,
+            "duration_ms": round((time.perf_counter() - start) * 1000, 1),
+            "status": status,
+            **attrs
+        }, ensure_ascii=False, default=str))
+
+def traced(name):
+    """Декоратор: оборачивает корутину в span."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def run_traced(func, *args, pool=None):
+    """run_in_executor, который передает trace_id в поток пула (по умолчанию - общий executor)."""
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return loop.run_in_executor(pool or executor, functools.partial(ctx.run, func, *args))
 
 def fix_thumb_url(url):
     """Увеличивает качество обложек от Google/YouTube Music."""
@@ -82,9 +315,12 @@ def search_ytmusic(query, search_type='songs'):
                         'title': item['title'],
                         'subtitle': f"YouTube • {item.get('uploader', 'Unknown')}",
                         'thumb': fix_thumb_url(item.get('thumbnail')),
-                        'type': 'VI'
+                        'type': 'VI',
+                        'artists': item.get('uploader'),
+                        'duration': item.get('duration')
                     })
                 except: continue
+            index_items(parsed_results)
             return parsed_results
 
         # filter может быть: songs, videos, albums, artists, playlists
@@ -104,7 +340,10 @@ def search_ytmusic(query, search_type='songs'):
                     'title': item['title'],
                     'subtitle': f"{artists} • {album}",
                     'thumb': thumb,
-                    'type': 'TR'
+                    'type': 'TR',
+                    'artists': artists,
+                    'album': album,
+                    'duration': item.get('duration_seconds')
                 })
             
             # Обработка АЛЬБОМОВ
@@ -119,7 +358,9 @@ def search_ytmusic(query, search_type='songs'):
                     'title': item['title'],
                     'subtitle': f"Альбом • {artists} ({year})",
                     'thumb': thumb,
-                    'type': 'AL'
+                    'type': 'AL',
+                    'artists': artists,
+                    'album': item['title']
                 })
             
             # Обработка АРТИСТОВ
@@ -130,9 +371,27 @@ def search_ytmusic(query, search_type='songs'):
                     'title': item.get('artist', 'Unknown Artist'),
                     'subtitle': "Исполнитель",
                     'thumb': thumb,
-                    'type': 'AR'
+                    'type': 'AR',
+                    'artists': item.get('artist')
+                })
+
+            # Обработка ПЛЕЙЛИСТОВ
+            elif search_type == 'playlists':
+                thumb = fix_thumb_url(item['thumbnails'][-1]['url']) if item.get('thumbnails') else None
+                # browseId плейлиста имеет префикс VL, yt-dlp нужен чистый playlistId
+                playlist_id = item['browseId']
+                if playlist_id.startswith('VL'):
+                    playlist_id = playlist_id[2:]
+                parsed_results.append({
+                    'id': playlist_id,
+                    'title': item['title'],
+                    'subtitle': f"Плейлист • {item.get('author', 'YouTube Music')} ({item.get('itemCount', '?')})",
+                    'thumb': thumb,
+                    'type': 'PL',
+                    'artists': item.get('author')
                 })
                 
+        index_items(parsed_results)
         return parsed_results
     except Exception as e:
         logger.error(f"Ошибка поиска ytmusic: {e}")
@@ -149,74 +408,345 @@ def get_album_tracks(browse_id):
                 'title': t['title']
             })
         album_thumb = fix_thumb_url(album.get('thumbnails', [{}])[-1].get('url'))
-        return tracks, album.get('title', 'Альбом'), album_thumb
+        album_title = album.get('title', 'Альбом')
+
+        # Треки альбома тоже попадают в локальный каталог
+        catalog_items = []
+        for t in album.get('tracks', []):
+            if not t.get('videoId'):
+                continue
+            artists = ", ".join(a['name'] for a in t.get('artists') or [])
+            catalog_items.append({
+                'id': t['videoId'], 'type': 'TR', 'title': t['title'], 'artists': artists,
+                'album': album_title, 'duration': t.get('duration_seconds'),
+                'subtitle': f"{artists} • {album_title}", 'thumb': album_thumb
+            })
+        index_items(catalog_items)
+        return tracks, album_title, album_thumb
     except Exception as e:
         logger.error(f"Ошибка получения альбома: {e}")
         return [], None, None
 
+def extract_playlist_id(text):
+    """Достает playlistId из ссылки вида ...?list=ID."""
+    match = re.search(r"[?&]list=([\w-]+)", text or "")
+    return match.group(1) if match else None
+
+def is_playlist_link(text):
+    """Ссылка именно на плейлист: в ссылках на трек из радио/микса есть еще и v=."""
+    return bool(extract_playlist_id(text)) and not re.search(r"[?&]v=", text)
+
+def playlist_url(playlist_id):
+    """
+    Ссылка на плейлист для yt-dlp. Миксы (RD + id трека, RDAMVM/RDMM + id трека) открываются
+    только через watch с исходным треком; остальные RD... (например, RDCLAK5uy_) - обычные плейлисты.
+    """
+    mix = re.fullmatch(r"RD(?:AMVM|MM)?([\w-]{11})", playlist_id)
+    if mix:
+        return f"https://www.youtube.com/watch?v={mix.group(1)}&list={playlist_id}"
+    return f"https://music.youtube.com/playlist?list={playlist_id}"
+
+def get_playlist_page(playlist_id, start, count):
+    """
+    Возвращает одну страницу плейлиста (треки с индекса start, не более count).
+    Используется плоское извлечение yt-dlp, поэтому весь плейлист в память не грузится.
+    Пустой список - плейлист закончился, None - ошибка получения.
+    """
+    cmd = [
+        'yt-dlp',
+        '--dump-json',
+        '--flat-playlist',
+        '--playlist-items', f'{start + 1}:{start + count}',
+        playlist_url(playlist_id)
+    ]
+    try:
+        proc = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8')
+        tracks = []
+        for line in proc.stdout.splitlines():
+            try:
+                item = json.loads(line)
+                tracks.append({'id': item['id'], 'title': item.get('title') or item['id']})
+            except: continue
+        if proc.returncode != 0 and not tracks:
+            logger.error(f"Ошибка получения плейлиста {playlist_id}: {proc.stderr.strip()}")
+            return None
+        return tracks
+    except Exception as e:
+        logger.error(f"Ошибка получения плейлиста: {e}")
+        return None
+
 def download_task(video_id, filename_prefix):
     """Скачивание и конвертация одного трека."""
     url = f"https://music.youtube.com/watch?v={video_id}"
     filename_base = os.path.join(TEMP_FOLDER, filename_prefix)
 
-    try:
-        # 1. Получаем метаданные через yt-dlp (dump-json)
-        # Используем subprocess для вызова внешнего exe
-        cmd_info = ['yt-dlp', '--dump-json', '--no-playlist', url]
-        proc = subprocess.run(cmd_info, capture_output=True, text=True, encoding='utf-8', check=True)
-        info = json.loads(proc.stdout)
-        
-        title = info.get('title', 'Unknown Track')
-        duration = info.get('duration', 0)
-        artist = info.get('artist') or info.get('uploader') or 'Unknown Artist'
-
-        # 2. Скачиваем трек
-        cmd_dl = [
-            'yt-dlp',
-            '-f', 'ba[ext=m4a]/bestaudio',
-            '--embed-thumbnail',
-            '--add-metadata',
-            '--no-playlist',
-            '--no-cache-dir',
-            '--no-check-certificate',
-            '-o', f'{filename_base}.%(ext)s',
-            url
-        ]
-        
-        # Попытки скачивания (2 попытки)
-        success = False
-        last_err = ""
-        for attempt in range(2):
-            result = subprocess.run(cmd_dl, capture_output=True, text=True, encoding='utf-8')
-            if result.returncode == 0:
-                success = True
-                break
-            last_err = result.stderr
-            logger.warning(f"Попытка {attempt+1} для {video_id} не удалась. Ошибка: {last_err.strip()}")
-            if attempt == 0:
-                import time
-                time.sleep(2)
-
-        if not success:
-            logger.error(f"Не удалось скачать {video_id} после всех попыток. Причина: {last_err}")
+    with span("download", video_id=video_id) as sp:
+        try:
+            # 1. Получаем метаданные через yt-dlp (dump-json)
+            # Используем subprocess для вызова внешнего exe
+            with span("download.metadata", video_id=video_id):
+                cmd_info = ['yt-dlp', '--dump-json', '--no-playlist', url]
+                proc = subprocess.run(cmd_info, capture_output=True, text=True, encoding='utf-8', check=True)
+                info = json.loads(proc.stdout)
+            
+            title = info.get('title', 'Unknown Track')
+            duration = info.get('duration', 0)
+            artist = info.get('artist') or info.get('uploader') or 'Unknown Artist'
+
+            # 2. Скачиваем трек
+            cmd_dl = [
+                'yt-dlp',
+                '-f', 'ba[ext=m4a]/bestaudio',
+                '--embed-thumbnail',
+                '--add-metadata',
+                '--no-playlist',
+                '--no-cache-dir',
+                '--no-check-certificate',
+                '-o', f'{filename_base}.%(ext)s',
+                url
+            ]
+            
+            # Попытки скачивания (2 попытки)
+            success = False
+            last_err = ""
+            with span("download.fetch", video_id=video_id) as fetch_sp:
+                for attempt in range(2):
+                    fetch_sp["attempts"] = attempt + 1
+                    result = subprocess.run(cmd_dl, capture_output=True, text=True, encoding='utf-8')
+                    if result.returncode == 0:
+                        success = True
+                        if result.stderr.strip():
+                            logger.debug(f"yt-dlp stderr для {video_id}: {result.stderr.strip()}")
+                        break
+                    last_err = result.stderr
+                    logger.warning(f"Попытка {attempt+1} для {video_id} не удалась. Ошибка: {last_err.strip()}")
+                    if attempt == 0:
+                        time.sleep(2)
+                if not success:
+                    fetch_sp["error"] = last_err.strip()[-500:]
+
+            if not success:
+                logger.error(f"Не удалось скачать {video_id} после всех попыток. Причина: {last_err}")
+                sp["error"] = "fetch failed"
+                return None, None, None, None, None, None
+
+            # Ищем, какой файл в итоге создался (m4a или fallback на webm/opus)
+            with span("download.postprocess", video_id=video_id) as post_sp:
+                final_filename = None
+                for ext in ['m4a', 'webm', 'mp3', 'opus']:
+                    p = f"{filename_base}.{ext}"
+                    if os.path.exists(p):
+                        final_filename = p
+                        post_sp["size"] = os.path.getsize(p)
+                        break
+            
+            if not final_filename:
+                sp["error"] = "output file not found"
+                return None, None, None, None, None, None
+
+            final_thumb_url = info.get('thumbnail')
+            return final_filename, title, duration, artist, None, final_thumb_url
+        except Exception as e:
+            logger.error(f"Download error: {e}")
+            sp["error"] = f"{type(e).__name__}: {e}"
             return None, None, None, None, None, None
 
-        # Ищем, какой файл в итоге создался (m4a или fallback на webm/opus)
-        final_filename = None
-        for ext in ['m4a', 'webm', 'mp3', 'opus']:
-            p = f"{filename_base}.{ext}"
-            if os.path.exists(p):
-                final_filename = p
-                break
-        
-        if not final_filename:
-            return None, None, None, None, None, None
+# --- ЛОКАЛЬНЫЙ КАТАЛОГ (SQLite FTS5) ---
+
+catalog_lock = threading.Lock()
+catalog = None
+
+def get_catalog():
+    """Открывает базу каталога при первом обращении, а не при импорте."""
+    global catalog
+    if catalog is None:
+        with catalog_lock:
+            if catalog is None:
+                conn = sqlite3.connect(CATALOG_DB, check_same_thread=False)
+                conn.executescript("""
+                    CREATE TABLE IF NOT EXISTS items (
+                        id TEXT PRIMARY KEY,
+                        type TEXT NOT NULL,
+                        title TEXT NOT NULL,
+                        artists TEXT,
+                        album TEXT,
+                        duration INTEGER,
+                        thumb TEXT,
+                        subtitle TEXT
+                    );
+                    CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(
+                        title, artists, album,
+                        content='items', content_rowid='rowid',
+                        tokenize='unicode61 remove_diacritics 2'
+                    );
+                    CREATE TRIGGER IF NOT EXISTS items_ai AFTER INSERT ON items BEGIN
+                        INSERT INTO items_fts(rowid, title, artists, album) VALUES (new.rowid, new.title, new.artists, new.album);
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS items_ad AFTER DELETE ON items BEGIN
+                        INSERT INTO items_fts(items_fts, rowid, title, artists, album) VALUES ('delete', old.rowid, old.title, old.artists, old.album);
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS items_au AFTER UPDATE ON items BEGIN
+                        INSERT INTO items_fts(items_fts, rowid, title, artists, album) VALUES ('delete', old.rowid, old.title, old.artists, old.album);
+                        INSERT INTO items_fts(rowid, title, artists, album) VALUES (new.rowid, new.title, new.artists, new.album);
+                    END;
+                    CREATE TABLE IF NOT EXISTS popularity (
+                        id TEXT PRIMARY KEY,
+                        requests INTEGER NOT NULL DEFAULT 0
+                    );
+                    CREATE TABLE IF NOT EXISTS request_stats (
+                        kind TEXT NOT NULL,
+                        key TEXT NOT NULL,
+                        score REAL NOT NULL DEFAULT 0,
+                        PRIMARY KEY (kind, key)
+                    );
+                    CREATE TABLE IF NOT EXISTS meta (
+                        key TEXT PRIMARY KEY,
+                        value REAL
+                    );
+                """)
+                catalog = conn
+    return catalog
+
+def index_items(items):
+    """Сохраняет результаты (формат search_ytmusic + artists/album/duration) в каталог."""
+    rows = [
+        (i['id'], i['type'], i['title'], i.get('artists'), i.get('album'),
+         i.get('duration'), i.get('thumb'), i.get('subtitle'))
+        for i in items if i.get('id') and i.get('title')
+    ]
+    if not rows:
+        return
+    try:
+        conn = get_catalog()
+        with catalog_lock, conn:
+            conn.executemany("""
+                INSERT INTO items (id, type, title, artists, album, duration, thumb, subtitle)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    type=excluded.type, title=excluded.title,
+                    artists=COALESCE(excluded.artists, artists), album=COALESCE(excluded.album, album),
+                    duration=COALESCE(excluded.duration, duration), thumb=COALESCE(excluded.thumb, thumb),
+                    subtitle=COALESCE(excluded.subtitle, subtitle)
+            """, rows)
+    except Exception as e:
+        logger.error(f"Ошибка записи в каталог: {e}")
+
+def search_catalog(query, item_type, limit=20):
+    """Ищет в локальном каталоге. Релевантность FTS (bm25) поднимается популярностью у наших пользователей."""
+    # Каждое слово - префиксный поиск, кавычки экранируются
+    tokens = [t.replace('"', '""') for t in re.findall(r"\w+", query.lower())]
+    if not tokens:
+        return []
+    match = " ".join(f'"{t}"*' for t in tokens)
+    try:
+        conn = get_catalog()
+        with catalog_lock:
+            rows = conn.execute("""
+                SELECT items.id, items.type, items.title, items.subtitle, items.thumb,
+                       bm25(items_fts), COALESCE(popularity.requests, 0)
+                FROM items_fts
+                JOIN items ON items.rowid = items_fts.rowid
+                LEFT JOIN popularity ON popularity.id = items.id
+                WHERE items_fts MATCH ? AND items.type = ?
+                ORDER BY bm25(items_fts)
+                LIMIT 50
+            """, (match, item_type)).fetchall()
+    except Exception as e:
+        logger.error(f"Ошибка поиска по каталогу: {e}")
+        return []
+
+    # bm25 отрицательный: чем меньше, тем лучше
+    rows.sort(key=lambda r: r[5] - math.log1p(r[6]))
+    return [
+        {'id': r[0], 'type': r[1], 'title': r[2], 'subtitle': r[3] or "", 'thumb': r[4]}
+        for r in rows[:limit]
+    ]
 
-        final_thumb_url = info.get('thumbnail')
-        return final_filename, title, duration, artist, None, final_thumb_url
+def record_request(kind, key):
+    """
+    Учитывает запрос пользователя: общий счетчик (ранжирование локального поиска)
+    и затухающий счетчик для трендов. kind - тип контента (TR/VI/AL/PL/AR) или Q для поисковых запросов.
+    """
+    try:
+        conn = get_catalog()
+        with catalog_lock, conn:
+            if kind != 'Q':
+                conn.execute("""
+                    INSERT INTO popularity (id, requests) VALUES (?, 1)
+                    ON CONFLICT(id) DO UPDATE SET requests = requests + 1
+                """, (key,))
+            conn.execute("""
+                INSERT INTO request_stats (kind, key, score) VALUES (?, ?, 1)
+                ON CONFLICT(kind, key) DO UPDATE SET score = score + 1
+            """, (kind, key))
     except Exception as e:
-        logger.error(f"Download error: {e}")
-        return None, None, None, None, None, None
+        logger.error(f"Ошибка обновления статистики: {e}")
+
+def record_request_later(kind, key):
+    """Запись статистики в потоке каталога без ожидания: обработчик запроса не задерживается."""
+    run_traced(record_request, kind, key, pool=catalog_executor)
+
+def decay_request_stats():
+    """
+    Затухание счетчиков с момента прошлого затухания; почти нулевые записи удаляются.
+    Время прошлого затухания хранится в каталоге, поэтому простой бота тоже учитывается.
+    """
+    now = time.time()
+    conn = get_catalog()
+    with catalog_lock, conn:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'last_decay'").fetchone()
+        if row:
+            factor = 0.5 ** (max(now - row[0], 0) / STATS_HALF_LIFE)
+            conn.execute("UPDATE request_stats SET score = score * ?", (factor,))
+            conn.execute("DELETE FROM request_stats WHERE score < 0.05")
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_decay', ?)", (now,))
+
+def top_requests(kinds, limit):
+    """Топ по затухающим счетчикам с названиями из каталога."""
+    placeholders = ",".join("?" * len(kinds))
+    conn = get_catalog()
+    with catalog_lock:
+        rows = conn.execute(f"""
+            SELECT request_stats.kind, request_stats.key, request_stats.score, items.title, items.subtitle
+            FROM request_stats
+            LEFT JOIN items ON items.id = request_stats.key
+            WHERE request_stats.kind IN ({placeholders})
+            ORDER BY request_stats.score DESC
+            LIMIT ?
+        """, (*kinds, limit)).fetchall()
+    return [
+        {'type': r[0], 'id': r[1], 'score': round(r[2], 2), 'title': r[3] or r[1], 'subtitle': r[4] or ""}
+        for r in rows
+    ]
+
+def index_artist(artist_id, artist_data):
+    """Кладет в каталог артиста и его треки/релизы из ответа get_artist."""
+    name = artist_data.get('name', 'Unknown Artist')
+    thumbs = artist_data.get('thumbnails') or [{}]
+    items = [{
+        'id': artist_id, 'type': 'AR', 'title': name, 'artists': name,
+        'subtitle': "Исполнитель", 'thumb': fix_thumb_url(thumbs[-1].get('url'))
+    }]
+    for song in artist_data.get('songs', {}).get('results', []):
+        if not song.get('videoId'):
+            continue
+        artists = ", ".join(a['name'] for a in song.get('artists') or []) or name
+        album = (song.get('album') or {}).get('name')
+        items.append({
+            'id': song['videoId'], 'type': 'TR', 'title': song['title'], 'artists': artists,
+            'album': album, 'subtitle': f"{artists} • {album or 'Single'}",
+            'thumb': fix_thumb_url(song['thumbnails'][-1]['url']) if song.get('thumbnails') else None
+        })
+    for section in ('albums', 'singles'):
+        for release in artist_data.get(section, {}).get('results', []):
+            if not release.get('browseId'):
+                continue
+            items.append({
+                'id': release['browseId'], 'type': 'AL', 'title': release['title'], 'artists': name,
+                'album': release['title'], 'subtitle': f"Альбом • {name} ({release.get('year', '')})",
+                'thumb': fix_thumb_url(release['thumbnails'][-1]['url']) if release.get('thumbnails') else None
+            })
+    index_items(items)
 
 # --- ОБРАБОТЧИКИ ---
 
@@ -255,12 +785,13 @@ async def process_sub_artist(callback: CallbackQuery):
     try:
         artist_data = await loop.run_in_executor(executor, ytmusic.get_artist, artist_id)
         artist_name = artist_data.get('name', 'Артист')
+        await run_traced(index_artist, artist_id, artist_data, pool=catalog_executor)
         
         subs = load_subs()
         if artist_id not in subs["artists"]:
             last_single = None
             if artist_data.get('singles', {}).get('results'):
-                last_single = artist_data['singles']['results'][0]['videoId']
+                last_single = artist_data['singles']['results'][0]['browseId']
             
             last_album = None
             if artist_data.get('albums', {}).get('results'):
@@ -365,6 +896,7 @@ async def check_artist_updates():
     """Фоновая задача для проверки новых релизов."""
     while True:
         logger.info("Проверка обновлений артистов...")
+        trace_id_var.set(new_trace_id("updates"))
         subs = load_subs()
         loop = asyncio.get_running_loop()
         changed = False
@@ -372,17 +904,20 @@ async def check_artist_updates():
         for artist_id, data in subs["artists"].items():
             try:
                 artist_info = await loop.run_in_executor(executor, ytmusic.get_artist, artist_id)
+                await run_traced(index_artist, artist_id, artist_info, pool=catalog_executor)
                 
-                # Проверка синглов (треков)
+                # Проверка синглов (в get_artist это релизы с browseId, как и альбомы)
                 singles = artist_info.get('singles', {}).get('results', [])
                 if singles:
                     latest_s = singles[0]
                     # Поддержка миграции со старого поля last_release
                     old_s_id = data.get('last_single') or data.get('last_release')
-                    if latest_s['videoId'] != old_s_id:
-                        data['last_single'] = latest_s['videoId']
+                    if latest_s['browseId'] != old_s_id:
+                        data['last_single'] = latest_s['browseId']
                         data.pop('last_release', None) # Удаляем старый ключ
-                        await notify_subscribers(data['subscribers'], data['name'], latest_s['title'], "Трек")
+                        callback_data = await prepare_release(latest_s['browseId'])
+                        await notify_subscribers(data['subscribers'], data['name'], latest_s['title'], "Трек",
+                                                 callback_data)
                         changed = True
 
                 # Проверка альбомов
@@ -391,7 +926,9 @@ async def check_artist_updates():
                     latest_a = albums[0]
                     if latest_a['browseId'] != data.get('last_album'):
                         data['last_album'] = latest_a['browseId']
-                        await notify_subscribers(data['subscribers'], data['name'], latest_a['title'], "Альбом")
+                        callback_data = await prepare_release(latest_a['browseId'])
+                        await notify_subscribers(data['subscribers'], data['name'], latest_a['title'], "Альбом",
+                                                 callback_data)
                         changed = True
 
             except Exception as e:
@@ -403,18 +940,109 @@ async def check_artist_updates():
         # Проверяем раз в 12 часов
         await asyncio.sleep(12 * 3600)
 
-async def notify_subscribers(user_ids, artist_name, title, release_type):
+async def prepare_release(browse_id):
+    """
+    Один раз получает треки нового релиза, запоминает их и (если есть хранилище) предзагружает.
+    Возвращает callback_data кнопки: rel:<browseId> отдает треки из кэша без обращения к YouTube.
+    """
+    tracks, _, thumb = await run_traced(get_album_tracks, browse_id)
+    if not tracks:
+        return f"select_AL:{browse_id}"
+
+    releases = load_releases()
+    releases[browse_id] = {"thumb": thumb, "tracks": tracks}
+    # Храним только последние релизы
+    for old_id in list(releases)[:-RELEASES_KEEP]:
+        del releases[old_id]
+    save_releases(releases)
+
+    await preupload_tracks(tracks, thumb)
+    return f"rel:{browse_id}"
+
+async def preupload_tracks(tracks, fallback_thumb=None):
+    """
+    Скачивает треки один раз и заливает их в чат-хранилище (новые релизы, популярное).
+    После этого пользователи получают их по file_id без повторных загрузок.
+    """
+    if not STORAGE_CHAT_ID:
+        return
+
+    sem = asyncio.Semaphore(3)
+    pending = [t for t in tracks if t['id'] not in file_cache]
+    results = await asyncio.gather(*[
+        download_in_queue(sem, t['id'], f"storage_{t['id']}") for t in pending
+    ])
+    for track_info, res in zip(pending, results):
+        if res and res[0]:
+            await send_downloaded_track(STORAGE_CHAT_ID, track_info['id'], res, fallback_thumb,
+                                        disable_notification=True)
+            await asyncio.sleep(0.5)
+        else:
+            logger.warning(f"Не удалось предзагрузить {track_info['id']} в хранилище.")
+
+# Предрассчитанный топ для /top и прогрева кэша
+trending = {"tracks": [], "albums": [], "queries": [], "updated": None}
+
+def is_off_peak():
+    start, end = WARM_HOURS
+    hour = time.localtime().tm_hour
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+async def cache_warmer():
+    """
+    Фоновая задача: затухание статистики, пересчет топа и, в часы низкой нагрузки,
+    предзагрузка популярных треков в хранилище и прогрев популярных поисковых запросов.
+    """
+    if not STORAGE_CHAT_ID:
+        logger.warning("STORAGE_CHAT_ID не задан: предзагрузка треков в хранилище (прогрев file_id) выключена.")
+    while True:
+        trace_id_var.set(new_trace_id("warmer"))
+        try:
+            with span("warmer") as sp:
+                await run_traced(decay_request_stats, pool=catalog_executor)
+                prune_rate_buckets()
+
+                trending["tracks"] = await run_traced(top_requests, ("TR", "VI"), WARM_TOP_TRACKS, pool=catalog_executor)
+                trending["albums"] = await run_traced(top_requests, ("AL",), 10, pool=catalog_executor)
+                trending["queries"] = await run_traced(top_requests, ("Q",), WARM_TOP_QUERIES, pool=catalog_executor)
+                trending["updated"] = time.strftime("%Y-%m-%d %H:%M")
+
+                sp["off_peak"] = is_off_peak()
+                if sp["off_peak"]:
+                    # Треки без file_id заливаем в хранилище (preupload_tracks пропускает закэшированные)
+                    await preupload_tracks(trending["tracks"])
+                    # Результаты популярных запросов попадают в локальный каталог
+                    for q in trending["queries"]:
+                        stype, query = q['id'].split(":", 1)
+                        await run_traced(search_ytmusic, query, stype)
+                        mark_refreshed((query, stype))
+                        await asyncio.sleep(1)
+        except Exception as e:
+            logger.error(f"Ошибка прогрева кэша: {e}")
+
+        await asyncio.sleep(WARM_INTERVAL)
+
+async def notify_subscribers(user_ids, artist_name, title, release_type, callback_data=None):
     """Вспомогательная функция для рассылки уведомлений."""
     logger.info(f"Новый {release_type} у {artist_name}: {title}")
     notification = (
         f"🔔 **Новый {release_type}!**\n\n"
         f"Исполнитель: {artist_name}\n"
-        f"Название: {title}\n\n"
-        f"Чтобы скачать, используйте поиск бота."
+        f"Название: {title}"
     )
+    markup = None
+    if callback_data:
+        # rel: отдает треки релиза из кэша file_id; select_AL - запасной вариант
+        markup = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="⬇️ Скачать", callback_data=callback_data)]
+        ])
+    else:
+        notification += "\n\nЧтобы скачать, используйте поиск бота."
     for user_id in user_ids:
         try:
-            await bot.send_message(user_id, notification, parse_mode="Markdown")
+            await bot.send_message(user_id, notification, parse_mode="Markdown", reply_markup=markup)
         except Exception:
             pass
 
@@ -427,7 +1055,9 @@ async def cmd_start(message: types.Message):
         "• `/song название` — поиск трека\n"
         "• `/album название` — поиск альбома\n"
         "• `/artist название` — поиск артиста\n\n"
-        "• `/video название` — поиск видео\n\n"
+        "• `/video название` — поиск видео\n"
+        "• `/playlist название или ссылка` — плейлист целиком\n"
+        "• `/top` — популярное у пользователей бота\n\n"
         "✨ **Inline-поиск (в любом чате):**\n"
         "Просто начни писать `@имя_бота` и запрос.\n\n"
         "🔔 **Подписки:**\n"
@@ -436,16 +1066,13 @@ async def cmd_start(message: types.Message):
         parse_mode="Markdown"
     )
 
-@dp.inline_query()
-async def inline_search(inline_query: types.InlineQuery):
-    text = inline_query.query
-    if not text or len(text) < 2:
-        return
-
+def parse_inline_query(text):
+    """Режим inline-поиска по префиксу запроса. Возвращает (search_type, запрос без префикса)."""
     # Определение режима: Альбом, Артист или Трек
     is_album = False
     is_artist = False
     is_video = False
+    is_playlist = False
     clean_query = text
     if text.lower().startswith(('alb ', 'альбом ', 'album ')):
         is_album = True
@@ -457,8 +1084,9 @@ async def inline_search(inline_query: types.InlineQuery):
     elif text.lower().startswith(('vid ', 'video ', 'видео ')):
         is_video = True
         clean_query = " ".join(text.split()[1:])
-
-    if not clean_query: return
+    elif text.lower().startswith(('pl ', 'playlist ', 'плейлист ')):
+        is_playlist = True
+        clean_query = " ".join(text.split()[1:])
 
     if is_album:
         search_type = 'albums'
@@ -466,11 +1094,75 @@ async def inline_search(inline_query: types.InlineQuery):
         search_type = 'artists'
     elif is_video:
         search_type = 'videos'
+    elif is_playlist:
+        search_type = 'playlists'
     else:
         search_type = 'songs'
-    
+    return search_type, clean_query
+
+# Когда запрос последний раз обновлялся из YouTube: (query, search_type) -> time.monotonic()
+catalog_refreshed = {}
+# Отложенное фоновое обновление по пользователю: новый inline-запрос отменяет предыдущий
+pending_refresh = {}
+
+def mark_refreshed(refresh_key):
+    """Запоминает время обновления; устаревшие (и при переполнении самые старые) записи удаляются."""
+    now = time.monotonic()
+    catalog_refreshed[refresh_key] = now
+    if len(catalog_refreshed) > CATALOG_REFRESH_MAX:
+        for key, ts in list(catalog_refreshed.items()):
+            if now - ts > CATALOG_REFRESH_INTERVAL:
+                del catalog_refreshed[key]
+        for key in sorted(catalog_refreshed, key=catalog_refreshed.get)[:len(catalog_refreshed) - CATALOG_REFRESH_MAX]:
+            del catalog_refreshed[key]
+
+async def refresh_catalog_later(user_id, clean_query, search_type):
+    """Обновляет каталог из YouTube, если за CATALOG_REFRESH_DELAY пользователь не допечатал запрос."""
+    try:
+        await asyncio.sleep(CATALOG_REFRESH_DELAY)
+        refresh_key = (clean_query.lower(), search_type)
+        if time.monotonic() - catalog_refreshed.get(refresh_key, 0) > CATALOG_REFRESH_INTERVAL:
+            mark_refreshed(refresh_key)
+            await run_traced(search_ytmusic, clean_query, search_type)
+    finally:
+        if pending_refresh.get(user_id) is asyncio.current_task():
+            del pending_refresh[user_id]
+
+@dp.inline_query()
+async def inline_search(inline_query: types.InlineQuery):
+    text = inline_query.query
+    if not text or len(text) < 2:
+        return
+
+    search_type, clean_query = parse_inline_query(text)
+    if not clean_query: return
+
+    # Сначала отвечаем из локального каталога, YouTube обновляет его в фоне.
+    # Если локально почти ничего нет - ждем YouTube, но не дольше INLINE_UPSTREAM_TIMEOUT.
     loop = asyncio.get_running_loop()
-    results = await loop.run_in_executor(executor, search_ytmusic, clean_query, search_type)
+    item_type = {'songs': 'TR', 'albums': 'AL', 'artists': 'AR', 'videos': 'VI', 'playlists': 'PL'}[search_type]
+    local_results = await run_traced(search_catalog, clean_query, item_type, pool=catalog_executor)
+
+    user_id = inline_query.from_user.id
+    if user_id in pending_refresh:
+        pending_refresh.pop(user_id).cancel() # Пользователь еще печатает
+
+    if len(local_results) >= INLINE_LOCAL_MIN:
+        results = local_results
+        pending_refresh[user_id] = asyncio.create_task(
+            refresh_catalog_later(user_id, clean_query, search_type)
+        )
+    else:
+        try:
+            results = await asyncio.wait_for(
+                loop.run_in_executor(executor, search_ytmusic, clean_query, search_type),
+                timeout=INLINE_UPSTREAM_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            logger.warning(f"YouTube не ответил за {INLINE_UPSTREAM_TIMEOUT}с на '{clean_query}', отвечаю из каталога")
+            results = []
+        if not results:
+            results = local_results
 
     articles = []
     for item in results:
@@ -478,6 +1170,7 @@ async def inline_search(inline_query: types.InlineQuery):
         # Если это трек: TYPE:TR
         # Если это альбом: TYPE:AL
         # Если это артист: TYPE:AR
+        # Если это плейлист: TYPE:PL
         content_text = f"💿 Выбрано: {item['title']}...\nID: {item['id']} TYPE:{item['type']} #music_load"
         
         article = InlineQueryResultArticle(
@@ -493,14 +1186,92 @@ async def inline_search(inline_query: types.InlineQuery):
 
     await inline_query.answer(articles, cache_time=60, is_personal=False)
 
+@dp.chosen_inline_result()
+async def inline_chosen(chosen: types.ChosenInlineResult):
+    """
+    Учитывает inline-запрос, только когда по нему выбрали результат: промежуточные
+    запросы, которые Telegram шлет по мере набора, в статистику не попадают.
+    Требует включенного /setinlinefeedback у BotFather.
+    """
+    search_type, clean_query = parse_inline_query(chosen.query)
+    if clean_query:
+        record_request_later('Q', f"{search_type}:{clean_query.lower().strip()}")
+
 # --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ЗАГРУЗКИ ---
 
+async def download_in_queue(sem, video_id, filename_prefix):
+    """Скачивание через семафор; ожидание своей очереди пишется отдельным спаном."""
+    with span("queue_wait", video_id=video_id):
+        await sem.acquire()
+    try:
+        return await run_traced(download_task, video_id, filename_prefix)
+    finally:
+        sem.release()
+
+async def send_cached_audio(message: types.Message, video_id: str):
+    """Отправляет трек по сохраненному file_id. Возвращает True, если получилось."""
+    file_id = file_cache.get(video_id)
+    if not file_id:
+        return False
+    try:
+        with span("upload", video_id=video_id, cached=True):
+            await message.answer_audio(file_id)
+        return True
+    except Exception as e:
+        # file_id мог устареть - забываем его и скачиваем заново
+        logger.warning(f"Не удалось отправить {video_id} из кэша: {e}")
+        file_cache.pop(video_id, None)
+        schedule_file_cache_save()
+        return False
+
+async def send_downloaded_track(chat_id, video_id: str, res, fallback_thumb=None, **kwargs):
+    """Отправляет скачанный трек в чат, запоминает file_id и удаляет временные файлы."""
+    path, title, duration, artist, thumb_path, thumb_url = res
+    try:
+        if os.path.getsize(path) > 50 * 1024 * 1024:
+            logger.warning(f"Файл {title} слишком велик (> 50MB) и будет пропущен.")
+            return False
+
+        thumb = None
+        if thumb_path and os.path.exists(thumb_path):
+            thumb = FSInputFile(thumb_path)
+        elif thumb_url:
+            thumb = URLInputFile(thumb_url)
+        elif fallback_thumb:
+            thumb = URLInputFile(fallback_thumb)
+
+        with span("upload", video_id=video_id, cached=False):
+            sent = await bot.send_audio(
+                chat_id,
+                FSInputFile(path),
+                title=title,
+                performer=artist,
+                duration=duration,
+                thumbnail=thumb,
+                **kwargs
+            )
+        remember_file_id(video_id, sent)
+        return True
+    except Exception as e:
+        logger.error(f"Error sending {title}: {e}")
+        return False
+    finally:
+        # Очистка
+        if os.path.exists(path): os.remove(path)
+        if thumb_path and os.path.exists(thumb_path): os.remove(thumb_path)
+
+@traced("handle_tr")
 async def handle_tr(message: types.Message, content_id: str):
+    if await send_cached_audio(message, content_id):
+        if message.text and "#music_load" in message.text:
+            try: await message.delete()
+            except: pass
+        return
+
     status_msg = await message.reply("⏳ `YouTube Music`: Скачиваю трек в M4A...")
-    loop = asyncio.get_running_loop()
     
-    file_path, title, duration, artist, thumb_path, thumb_url = await loop.run_in_executor(
-        executor, download_task, content_id, content_id
+    file_path, title, duration, artist, thumb_path, thumb_url = await run_traced(
+        download_task, content_id, content_id
     )
     
     if file_path and os.path.exists(file_path):
@@ -518,13 +1289,15 @@ async def handle_tr(message: types.Message, content_id: str):
             elif thumb_url:
                 thumb = URLInputFile(thumb_url)
 
-            await message.answer_audio(
-                audio, 
-                title=title, 
-                performer=artist,
-                duration=duration, 
-                thumbnail=thumb
-            )
+            with span("upload", video_id=content_id, cached=False):
+                sent = await message.answer_audio(
+                    audio, 
+                    title=title, 
+                    performer=artist,
+                    duration=duration, 
+                    thumbnail=thumb
+                )
+            remember_file_id(content_id, sent)
         finally:
             if os.path.exists(file_path): os.remove(file_path)
             if thumb_path and os.path.exists(thumb_path): os.remove(thumb_path)
@@ -540,12 +1313,18 @@ async def handle_tr(message: types.Message, content_id: str):
             try: await message.delete()
             except: pass
 
+@traced("handle_vi")
 async def handle_vi(message: types.Message, content_id: str):
+    if await send_cached_audio(message, content_id):
+        if message.text and "#music_load" in message.text:
+            try: await message.delete()
+            except: pass
+        return
+
     status_msg = await message.reply("⏳ `YouTube`: Скачиваю аудио из видео...")
-    loop = asyncio.get_running_loop()
     
-    file_path, title, duration, artist, thumb_path, thumb_url = await loop.run_in_executor(
-        executor, download_task, content_id, content_id
+    file_path, title, duration, artist, thumb_path, thumb_url = await run_traced(
+        download_task, content_id, content_id
     )
     
     if file_path and os.path.exists(file_path):
@@ -562,13 +1341,15 @@ async def handle_vi(message: types.Message, content_id: str):
             elif thumb_url:
                 thumb = URLInputFile(thumb_url)
 
-            await message.answer_audio(
-                audio, 
-                title=title, 
-                performer=artist,
-                duration=duration, 
-                thumbnail=thumb
-            )
+            with span("upload", video_id=content_id, cached=False):
+                sent = await message.answer_audio(
+                    audio, 
+                    title=title, 
+                    performer=artist,
+                    duration=duration, 
+                    thumbnail=thumb
+                )
+            remember_file_id(content_id, sent)
         finally:
             if os.path.exists(file_path): os.remove(file_path)
             if thumb_path and os.path.exists(thumb_path): os.remove(thumb_path)
@@ -584,11 +1365,11 @@ async def handle_vi(message: types.Message, content_id: str):
             try: await message.delete()
             except: pass
 
+@traced("handle_al")
 async def handle_al(message: types.Message, content_id: str):
     status_msg = await message.reply("⏳ `YouTube Music`: Получаю список треков альбома...")
-    loop = asyncio.get_running_loop()
     
-    tracks, album_title, album_thumb = await loop.run_in_executor(executor, get_album_tracks, content_id)
+    tracks, album_title, album_thumb = await run_traced(get_album_tracks, content_id)
     
     if not tracks:
         await status_msg.edit_text("❌ Не удалось получить информацию об альбоме.")
@@ -606,46 +1387,26 @@ async def handle_al(message: types.Message, content_id: str):
     downloaded_results = [None] * total # Сохраняем порядок треков
 
     async def download_and_send(track_info, index):
-        async with sem:
-            file_prefix = f"{content_id}_{track_info['id']}"
-            res = await loop.run_in_executor(
-                executor, download_task, track_info['id'], file_prefix
-            )
-            downloaded_results[index] = res
+        if track_info['id'] in file_cache:
+            return # Уже отправлялся раньше - отправим по file_id
+        file_prefix = f"{content_id}_{track_info['id']}"
+        downloaded_results[index] = await download_in_queue(sem, track_info['id'], file_prefix)
 
     tasks = [download_and_send(track, i) for i, track in enumerate(tracks)]
     await asyncio.gather(*tasks)
 
     # Отправка по одному треку (сохраняя порядок)
-    for res in downloaded_results:
+    for track_info, res in zip(tracks, downloaded_results):
+        if res is None:
+            if await send_cached_audio(message, track_info['id']):
+                await asyncio.sleep(0.5)
+                continue
+            # file_id устарел - качаем трек заново
+            res = await run_traced(
+                download_task, track_info['id'], f"{content_id}_{track_info['id']}"
+            )
         if res and res[0]:
-            path, title, duration, artist, thumb_path, thumb_url = res
-            
-            if os.path.getsize(path) > 50 * 1024 * 1024:
-                logger.warning(f"Файл {title} слишком велик (> 50MB) и будет пропущен.")
-            else:
-                try:
-                    thumb = None
-                    if thumb_path and os.path.exists(thumb_path):
-                        thumb = FSInputFile(thumb_path)
-                    elif thumb_url:
-                        thumb = URLInputFile(thumb_url)
-                    elif album_thumb:
-                        thumb = URLInputFile(album_thumb)
-
-                    await message.answer_audio(
-                        FSInputFile(path),
-                        title=title,
-                        performer=artist,
-                        duration=duration,
-                        thumbnail=thumb
-                    )
-                except Exception as e:
-                    logger.error(f"Error sending {title}: {e}")
-            
-            # Очистка
-            if os.path.exists(path): os.remove(path)
-            if thumb_path and os.path.exists(thumb_path): os.remove(thumb_path)
+            await send_downloaded_track(message.chat.id, track_info['id'], res, album_thumb)
             await asyncio.sleep(0.5) # Небольшая пауза между отправками
 
     await status_msg.delete()
@@ -653,11 +1414,160 @@ async def handle_al(message: types.Message, content_id: str):
         try: await message.delete()
         except: pass
 
+# Квоты на плейлисты: user_id -> [дата, скачано треков за день]
+playlist_usage = {}
+active_playlist_jobs = set()
+
+def playlist_quota_left(user_id):
+    today = time.strftime("%Y-%m-%d")
+    day, used = playlist_usage.get(user_id, [today, 0])
+    if day != today:
+        used = 0
+    return max(PLAYLIST_DAILY_QUOTA - used, 0)
+
+def spend_playlist_quota(user_id, amount):
+    today = time.strftime("%Y-%m-%d")
+    day, used = playlist_usage.get(user_id, [today, 0])
+    if day != today:
+        used = 0
+    playlist_usage[user_id] = [today, used + amount]
+
+@traced("handle_pl")
+async def handle_pl(message: types.Message, content_id: str, user_id: int = None):
+    """
+    Загрузка плейлиста постранично: страница треков скачивается (не более 3 параллельно),
+    отправляется и удаляется с диска, после чего сохраняется позиция для продолжения.
+    """
+    user_id = user_id or message.from_user.id
+    if user_id in active_playlist_jobs:
+        await message.reply("⏳ У вас уже загружается плейлист. Дождитесь окончания.")
+        return
+
+    quota_left = playlist_quota_left(user_id)
+    if quota_left <= 0:
+        await message.reply(f"❌ Дневной лимит ({PLAYLIST_DAILY_QUOTA} треков из плейлистов) исчерпан. Попробуйте завтра.")
+        return
+
+    active_playlist_jobs.add(user_id)
+    try:
+        progress = load_playlist_progress()
+        progress_key = f"{message.chat.id}:{content_id}"
+        start = progress.get(progress_key, 0)
+        job_end = start + PLAYLIST_MAX_TRACKS
+
+        if start:
+            status_msg = await message.reply(f"⏳ Продолжаю загрузку плейлиста с трека {start + 1}...")
+        else:
+            status_msg = await message.reply("⏳ `YouTube Music`: Получаю список треков плейлиста...")
+
+        sem = asyncio.Semaphore(3)
+
+        index = start
+        sent_count = 0
+        finished = False
+        failed = False
+        while index < job_end:
+            count = min(PLAYLIST_PAGE_SIZE, job_end - index)
+            page = await run_traced(get_playlist_page, content_id, index, count)
+            if page is None:
+                failed = True # Ошибка сети/YouTube: позиция остается сохраненной
+                break
+            if not page:
+                finished = True
+                break
+
+            # Закэшированные треки не скачиваются и не расходуют квоту
+            batch = []
+            for track_info in page:
+                if track_info['id'] not in file_cache:
+                    if quota_left <= 0:
+                        break
+                    quota_left -= 1
+                batch.append(track_info)
+
+            to_download = [t for t in batch if t['id'] not in file_cache]
+            downloads = dict(zip(
+                [t['id'] for t in to_download],
+                await asyncio.gather(*[
+                    download_in_queue(sem, t['id'], f"{content_id}_{t['id']}") for t in to_download
+                ])
+            ))
+            # Квота расходуется только на успешные загрузки, место неудачных возвращается
+            downloaded_ok = sum(1 for res in downloads.values() if res and res[0])
+            spend_playlist_quota(user_id, downloaded_ok)
+            quota_left += len(to_download) - downloaded_ok
+
+            for track_info in batch:
+                res = downloads.get(track_info['id'])
+                if res is None:
+                    if await send_cached_audio(message, track_info['id']):
+                        sent_count += 1
+                        await asyncio.sleep(0.5)
+                        continue
+                    # file_id устарел - качаем трек заново, как в handle_al
+                    res = await download_in_queue(sem, track_info['id'], f"{content_id}_{track_info['id']}")
+                    if res and res[0]:
+                        spend_playlist_quota(user_id, 1)
+                        quota_left -= 1
+                if res and res[0] and await send_downloaded_track(message.chat.id, track_info['id'], res):
+                    sent_count += 1
+                await asyncio.sleep(0.5)
+
+            index += len(batch)
+            progress = load_playlist_progress()
+            progress[progress_key] = index
+            save_playlist_progress(progress)
+
+            try:
+                await status_msg.edit_text(f"📃 Плейлист: отправлено {sent_count}, обработано {index}...")
+            except Exception:
+                pass
+
+            if len(batch) < len(page):
+                break # Квота исчерпана посреди страницы
+            if len(page) < count:
+                finished = True
+                break
+
+        if failed and index == 0:
+            await status_msg.edit_text("❌ Не удалось получить треки плейлиста.")
+        elif failed:
+            await status_msg.edit_text(
+                f"❌ Не удалось получить треки плейлиста после трека {index}. "
+                f"Прогресс сохранен - отправьте плейлист снова позже, чтобы продолжить."
+            )
+        elif finished:
+            progress = load_playlist_progress()
+            progress.pop(progress_key, None)
+            save_playlist_progress(progress)
+            if index == 0:
+                await status_msg.edit_text("❌ Плейлист пуст.")
+            elif index == start:
+                # Сохраненная позиция уже за концом плейлиста (ровно кратен лимиту или его укоротили)
+                await status_msg.edit_text("✅ Плейлист уже загружен полностью.")
+            else:
+                await status_msg.edit_text(f"✅ Плейлист загружен. Отправлено треков: {sent_count}.")
+        elif quota_left <= 0:
+            await status_msg.edit_text(
+                f"⏸ Дневной лимит исчерпан на треке {index}. Отправьте плейлист завтра, чтобы продолжить."
+            )
+        else:
+            await status_msg.edit_text(
+                f"⏸ Отправлено {sent_count} (до трека {index}). Отправьте плейлист снова, чтобы продолжить."
+            )
+    finally:
+        active_playlist_jobs.discard(user_id)
+        if message.text and "#music_load" in message.text:
+            try: await message.delete()
+            except: pass
+
+@traced("handle_ar")
 async def handle_ar(message: types.Message, content_id: str, artist_name: str = None):
     if not artist_name:
         loop = asyncio.get_running_loop()
         artist_data = await loop.run_in_executor(executor, ytmusic.get_artist, content_id)
         artist_name = artist_data.get('name', 'Артист')
+        await run_traced(index_artist, content_id, artist_data, pool=catalog_executor)
         
     keyboard = [[InlineKeyboardButton(text=f"Подписаться на {artist_name}", callback_data=f"sub_artist:{content_id}")]]
     markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
@@ -744,15 +1654,41 @@ async def cmd_search(message: types.Message, command: Command):
         await message.answer("Ничего не найдено.")
         return
 
+    record_request_later('Q', f"{stype}:{query.lower().strip()}")
     markup = generate_search_markup(results, query, stype, 0)
     await message.answer(f"🔍 Результаты поиска {cmd}:", reply_markup=markup)
 
+@dp.message(Command("playlist"))
+async def cmd_playlist(message: types.Message, command: Command):
+    """Плейлист по ссылке или поиск плейлистов: /playlist Название"""
+    query = command.args
+    if not query:
+        await message.answer("Введите название или ссылку на плейлист: `/playlist Название`", parse_mode="Markdown")
+        return
+
+    playlist_id = extract_playlist_id(query)
+    if playlist_id:
+        await handle_pl(message, playlist_id)
+        return
+
+    loop = asyncio.get_running_loop()
+    results = await loop.run_in_executor(executor, search_ytmusic, query, "playlists")
+
+    if not results:
+        await message.answer("Ничего не найдено.")
+        return
+
+    record_request_later('Q', f"playlists:{query.lower().strip()}")
+    markup = generate_search_markup(results, query, "playlists", 0)
+    await message.answer("🔍 Результаты поиска playlist:", reply_markup=markup)
+
 @dp.callback_query(F.data.startswith("select_"))
 async def process_select_callback(callback: CallbackQuery):
     parts = callback.data.split(":")
     ctype = parts[0].split("_")[1]
     cid = parts[1]
     await callback.answer()
+    record_request_later(ctype, cid)
     if ctype == "TR":
         await handle_tr(callback.message, cid)
     elif ctype == "AL":
@@ -761,6 +1697,31 @@ async def process_select_callback(callback: CallbackQuery):
         await handle_ar(callback.message, cid)
     elif ctype == "VI":
         await handle_vi(callback.message, cid)
+    elif ctype == "PL":
+        await handle_pl(callback.message, cid, callback.from_user.id)
+
+@dp.callback_query(F.data.startswith("rel:"))
+async def process_release_callback(callback: CallbackQuery):
+    """Кнопка из уведомления о релизе: треки берутся из releases.json и кэша file_id."""
+    browse_id = callback.data.split(":", 1)[1]
+    await callback.answer()
+    record_request_later('AL', browse_id)
+    release = load_releases().get(browse_id)
+    if not release:
+        # Релиз уже вытеснен из releases.json - обычная загрузка альбома
+        await handle_al(callback.message, browse_id)
+        return
+    await handle_rel(callback.message, release)
+
+@traced("handle_rel")
+async def handle_rel(message: types.Message, release):
+    for track_info in release['tracks']:
+        if not await send_cached_audio(message, track_info['id']):
+            # Нет в кэше (хранилище не настроено или предзагрузка не удалась) - качаем сами
+            res = await run_traced(download_task, track_info['id'], f"rel_{track_info['id']}")
+            if res and res[0]:
+                await send_downloaded_track(message.chat.id, track_info['id'], res, release.get('thumb'))
+        await asyncio.sleep(0.5)
 
 @dp.message(F.text.contains("#music_load"))
 async def process_download(message: types.Message):
@@ -772,6 +1733,7 @@ async def process_download(message: types.Message):
 
     content_id = id_match.group(1)
     content_type = type_match.group(1)
+    record_request_later(content_type, content_id)
     
     if content_type == "TR":
         await handle_tr(message, content_id)
@@ -783,6 +1745,288 @@ async def process_download(message: types.Message):
         await handle_al(message, content_id)
     elif content_type == "VI":
         await handle_vi(message, content_id)
+    elif content_type == "PL":
+        await handle_pl(message, content_id)
+
+@dp.message(F.chat.type == "private", F.text.regexp(r"[?&]list=[\w-]+"))
+async def process_playlist_link(message: types.Message):
+    """Ссылка на плейлист или микс, присланная в личку."""
+    if not is_playlist_link(message.text):
+        # Ссылка на трек из радио/микса - весь список без явной просьбы не качаем
+        await message.reply(
+            "Это ссылка на трек из микса. Чтобы загрузить весь список, отправьте `/playlist ссылка`.",
+            parse_mode="Markdown"
+        )
+        return
+    await handle_pl(message, extract_playlist_id(message.text))
+
+@dp.message(Command("top"))
+async def cmd_top(message: types.Message):
+    """Популярное у пользователей бота (из предрассчитанного топа)."""
+    if not trending["tracks"] and not trending["albums"]:
+        await message.answer("📊 Статистика еще собирается, загляните позже.")
+        return
+
+    keyboard = []
+    for item in trending["tracks"][:10]:
+        btn_text = f"🎵 {item['title']}"
+        if len(btn_text) > 50: btn_text = btn_text[:47] + "..."
+        keyboard.append([InlineKeyboardButton(text=btn_text, callback_data=f"select_{item['type']}:{item['id']}")])
+    for item in trending["albums"][:5]:
+        btn_text = f"💿 {item['title']}"
+        if len(btn_text) > 50: btn_text = btn_text[:47] + "..."
+        keyboard.append([InlineKeyboardButton(text=btn_text, callback_data=f"select_AL:{item['id']}")])
+
+    text = "📊 **Сейчас популярно**"
+    # Запросы - пользовательский текст, убираем символы разметки Markdown
+    queries = [re.sub(r"[*_`\[]", "", q['id'].split(":", 1)[1]) for q in trending["queries"][:5]]
+    if queries:
+        text += "\n\nЧасто ищут: " + ", ".join(queries)
+    text += f"\n\n_Обновлено: {trending['updated']}_"
+    await message.answer(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard), parse_mode="Markdown")
+
+# --- ТРАССИРОВКА АПДЕЙТОВ И ПРОФИЛИРОВАНИЕ ---
+
+@dp.update.outer_middleware()
+async def trace_middleware(handler, event: types.Update, data):
+    """Выдает каждому апдейту trace_id; он попадает во все спаны обработки."""
+    token = trace_id_var.set(new_trace_id(f"u{event.update_id}"))
+    user = data.get("event_from_user")
+    try:
+        with span("update", update_id=event.update_id, event=event.event_type,
+                  user_id=user.id if user else None):
+            return await handler(event, data)
+    finally:
+        trace_id_var.reset(token)
+
+# --- ОГРАНИЧЕНИЕ ЧАСТОТЫ ЗАПРОСОВ ---
+
+# (scope, id, категория) -> [токены, время последнего пополнения]
+rate_buckets = {}
+# Счетчики для мониторинга: категория -> число пропущенных/отклоненных запросов
+rate_limit_stats = {"allowed": {}, "rejected": {}}
+# (user_id, категория) -> до какого момента повторно не предупреждать об отказе
+rate_notified = {}
+
+def classify_request(event: types.Update):
+    """Категория лимита для апдейта: search, inline, download, bulk или None (не ограничивается)."""
+    if event.inline_query:
+        # Короткие запросы inline_search игнорирует - и токен за них не списываем
+        text = event.inline_query.query
+        if not text or len(text) < 2 or not parse_inline_query(text)[1]:
+            return None
+        return "inline"
+
+    if event.callback_query:
+        data = event.callback_query.data or ""
+        if data.startswith(("select_AL:", "select_PL:")):
+            return "bulk"
+        if data.startswith(("select_TR:", "select_VI:", "rel:")):
+            return "download"
+        if data.startswith(("sp:", "select_AR:")):
+            return "search"
+        return None
+
+    if event.message and event.message.text:
+        text = event.message.text
+        if "#music_load" in text:
+            type_match = re.search(r"TYPE:(\w+)", text)
+            content_type = type_match.group(1) if type_match else None
+            if content_type in ("AL", "PL"):
+                return "bulk"
+            if content_type in ("TR", "VI"):
+                return "download"
+            return "search"
+        command = text.split()[0].split("@")[0].lower() if text.startswith("/") else None
+        if command == "/playlist" and extract_playlist_id(text):
+            return "bulk"
+        if command in ("/song", "/album", "/artist", "/video", "/playlist", "/follow"):
+            return "search"
+        if event.message.chat.type == "private" and is_playlist_link(text):
+            return "bulk"
+    return None
+
+def take_tokens(buckets):
+    """
+    Списывает по токену из всех корзин сразу или ни из одной.
+    buckets: [(ключ, [емкость, пополнение, период])]. Возвращает 0 или через сколько секунд повторить.
+    """
+    now = time.monotonic()
+    retry_after = 0.0
+    for key, (capacity, refill, period) in buckets:
+        tokens, updated = rate_buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * refill / period)
+        rate_buckets[key] = [tokens, now]
+        if tokens < 1:
+            retry_after = max(retry_after, (1 - tokens) * period / refill)
+    if retry_after:
+        return retry_after
+    for key, _ in buckets:
+        rate_buckets[key][0] -= 1
+    return 0
+
+def validate_rate_tiers():
+    """Тарифы из RATE_TIERS должны быть описаны в RATE_LIMITS ("chat" - только для групп)."""
+    return sorted({
+        tier for tier in RATE_TIERS.values()
+        if tier not in RATE_LIMITS or tier == "chat"
+    })
+
+def prune_rate_buckets():
+    """Удаляет давно не использованные корзины: за это время они все равно полностью пополнились."""
+    max_period = max(limit[2] for limits in RATE_LIMITS.values() for limit in limits.values())
+    now = time.monotonic()
+    for key in [k for k, (_, updated) in rate_buckets.items() if now - updated > max_period]:
+        del rate_buckets[key]
+    for key in [k for k, until in rate_notified.items() if until < now]:
+        del rate_notified[key]
+
+@dp.update.outer_middleware()
+async def rate_limit_middleware(handler, event: types.Update, data):
+    """Token bucket на пользователя и на групповой чат с отдельными бюджетами по категориям."""
+    category = classify_request(event)
+    user = data.get("event_from_user")
+    if not category or not user or user.id in ADMIN_IDS:
+        return await handler(event, data)
+
+    tier = RATE_TIERS.get(user.id, "default")
+    buckets = [(("user", user.id, category), RATE_LIMITS[tier][category])]
+    chat = data.get("event_chat")
+    if chat and chat.id != user.id:
+        buckets.append((("chat", chat.id, category), RATE_LIMITS["chat"][category]))
+
+    retry_after = take_tokens(buckets)
+    counter = rate_limit_stats["rejected" if retry_after else "allowed"]
+    counter[category] = counter.get(category, 0) + 1
+    if not retry_after:
+        return await handler(event, data)
+
+    # Быстрый отказ без обращения к YouTube. Сообщением предупреждаем не чаще раза за окно,
+    # иначе флудящий пользователь упрет в лимиты Telegram уже самого бота
+    seconds = math.ceil(retry_after)
+    text = f"⏳ Слишком много запросов. Попробуйте через {seconds} с."
+    now = time.monotonic()
+    notify = rate_notified.get((user.id, category), 0) <= now
+    if notify:
+        rate_notified[(user.id, category)] = now + retry_after
+        logger.info(f"Лимит {category} для {user.id}: повтор через {seconds} с")
+    if event.callback_query:
+        # На callback отвечать нужно всегда (иначе у кнопки крутятся часики), но alert - один раз
+        await event.callback_query.answer(text, show_alert=notify)
+    elif event.inline_query:
+        await event.inline_query.answer(
+            [], cache_time=seconds, is_personal=True,
+            button=InlineQueryResultsButton(text=text, start_parameter="ratelimit")
+        )
+    elif event.message and notify:
+        await event.message.reply(text)
+
+def format_task_dump():
+    """Стеки всех asyncio-задач (что сейчас ждет и где)."""
+    out = io.StringIO()
+    tasks = asyncio.all_tasks()
+    out.write(f"Задач: {len(tasks)}\n\n")
+    for task in tasks:
+        out.write(f"--- {task.get_name()} ---\n")
+        task.print_stack(limit=10, file=out)
+        out.write("\n")
+    return out.getvalue()
+
+PROFILE_STALL_THRESHOLD = 0.2  # С какой задержки event loop (сек) снимать стек как "зависание"
+PROFILE_TASK_DUMP_EVERY = 5    # Как часто (сек) снимать дамп asyncio-задач во время профилирования
+PROFILE_MAX_SAMPLES = 20       # Сколько снимков каждого вида хранить в отчете
+profile_running = False        # Одновременно может работать только один профайлер
+
+def watch_loop_stalls(loop_thread_id, state, stop):
+    """
+    Поток-сторож: если event loop давно не отмечался, снимает стек его потока прямо во время
+    зависания (из самого loop это невозможно - к моменту замера он уже отвис).
+    """
+    stalled = False
+    while not stop.wait(0.05):
+        lag = time.monotonic() - state["last_tick"]
+        if lag > PROFILE_STALL_THRESHOLD and not stalled:
+            stalled = True
+            frame = sys._current_frames().get(loop_thread_id)
+            if frame and len(state["stalls"]) < PROFILE_MAX_SAMPLES:
+                state["stalls"].append(
+                    f"--- зависание > {lag * 1000:.0f} мс, {time.strftime('%H:%M:%S')} ---\n"
+                    + "".join(traceback.format_stack(frame))
+                )
+        elif lag <= PROFILE_STALL_THRESHOLD:
+            stalled = False
+
+@dp.message(Command("profile"))
+async def cmd_profile(message: types.Message, command: Command):
+    """
+    /profile N - на N секунд включает cProfile в потоке event loop и замер задержки цикла.
+    Во время замера снимаются стеки зависаний и периодические дампы asyncio-задач,
+    затем все присылается одним отчетом. Только для ADMIN_IDS.
+    """
+    global profile_running
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    try:
+        seconds = min(max(int(command.args or 10), 1), 300)
+    except ValueError:
+        await message.answer("Использование: `/profile 10`", parse_mode="Markdown")
+        return
+    if profile_running:
+        # Второй cProfile в том же потоке либо падает (3.12+), либо подменяет первый
+        await message.answer("⏱ Профилирование уже идет, дождитесь отчета.")
+        return
+
+    profile_running = True
+    try:
+        await message.answer(f"⏱ Профилирую {seconds} с...")
+        profiler = cProfile.Profile()
+        max_lag = 0.0
+        task_dumps = []
+        state = {"last_tick": time.monotonic(), "stalls": []}
+        stop = threading.Event()
+        watchdog = threading.Thread(
+            target=watch_loop_stalls, args=(threading.get_ident(), state, stop),
+            name="profile-watchdog", daemon=True
+        )
+        deadline = time.monotonic() + seconds
+        next_dump = time.monotonic()
+        watchdog.start()
+        profiler.enable()
+        try:
+            # Цикл проверки задержки: sleep(0.1) должен просыпаться вовремя, если loop не заблокирован
+            while time.monotonic() < deadline:
+                expected = time.monotonic() + 0.1
+                await asyncio.sleep(0.1)
+                now = time.monotonic()
+                state["last_tick"] = now
+                lag = now - expected
+                max_lag = max(max_lag, lag)
+                # Дамп задач - по расписанию и сразу после зависания (какие задачи его пережидали)
+                if (now >= next_dump or lag > PROFILE_STALL_THRESHOLD) and len(task_dumps) < PROFILE_MAX_SAMPLES:
+                    reason = f"после задержки {lag * 1000:.0f} мс" if lag > PROFILE_STALL_THRESHOLD else "по расписанию"
+                    task_dumps.append(f"=== {time.strftime('%H:%M:%S')}, {reason} ===\n{format_task_dump()}")
+                    next_dump = now + PROFILE_TASK_DUMP_EVERY
+        finally:
+            profiler.disable()
+            stop.set()
+
+        stats_out = io.StringIO()
+        pstats.Stats(profiler, stream=stats_out).sort_stats("cumulative").print_stats(40)
+        report = (
+            f"Профиль за {seconds} с, максимальная задержка event loop: {max_lag * 1000:.0f} мс\n\n"
+            f"{stats_out.getvalue()}\n\n"
+            f"=== Стеки event loop во время зависаний ({len(state['stalls'])}) ===\n"
+            + ("\n".join(state["stalls"]) or "нет\n")
+            + f"\n\n=== asyncio tasks ({len(task_dumps)} снимков) ===\n"
+            + "\n".join(task_dumps)
+        )
+        logger.info(f"Профилирование завершено, задержка loop до {max_lag * 1000:.0f} мс")
+        await message.answer_document(
+            BufferedInputFile(report.encode('utf-8'), filename=f"profile_{int(time.time())}.txt"),
+            caption=f"Макс. задержка event loop: {max_lag * 1000:.0f} мс, зависаний: {len(state['stalls'])}"
+        )
+    finally:
+        profile_running = False
 
 # --- НАСТРОЙКА МЕНЮ КОМАНД ---
 async def set_main_menu(bot: Bot):
@@ -791,17 +2035,101 @@ async def set_main_menu(bot: Bot):
         BotCommand(command="album", description="💿 Поиск альбома"),
         BotCommand(command="artist", description="👤 Поиск артиста"),
         BotCommand(command="video", description="🎬 Поиск видео"),
+        BotCommand(command="playlist", description="📃 Загрузить плейлист"),
+        BotCommand(command="top", description="📊 Популярное"),
         BotCommand(command="follow", description="🔔 Подписаться"),
         BotCommand(command="unfollow", description="🔕 Отписаться"),
         BotCommand(command="start", description="📖 Инструкция")
     ]
-    await bot.set_my_commands(main_menu_commands)
+    try:
+        await bot.set_my_commands(main_menu_commands)
+    except Exception as e:
+        logger.error(f"Не удалось обновить меню команд: {e}")
+
+# --- ГОТОВНОСТЬ И HEALTH-ЭНДПОИНТЫ ---
+
+startup_state = {"ready": False, "ready_after_ms": None, "temp_cleanup": "pending"}
+
+@dp.startup()
+async def on_startup():
+    startup_state["ready"] = True
+    startup_state["ready_after_ms"] = round((time.perf_counter() - STARTED_AT) * 1000)
+    logger.info(f"Бот готов к работе через {startup_state['ready_after_ms']} мс после запуска")
+
+@dp.shutdown()
+async def on_shutdown():
+    startup_state["ready"] = False
+
+async def start_health_server(port):
+    """
+    /health - процесс жив, /ready - бот принимает апдейты (200) или еще нет (503),
+    /metrics - счетчики лимитов в формате Prometheus.
+    aiohttp уже есть в зависимостях aiogram.
+    """
+    from aiohttp import web
+
+    def state():
+        return {
+            **startup_state,
+            "uptime_s": round(time.perf_counter() - STARTED_AT, 1),
+            "ytmusic_client": ytmusic.ready,
+            "catalog_open": catalog is not None,
+            "warm_preupload": "on" if STORAGE_CHAT_ID else "off: STORAGE_CHAT_ID not set",
+            "rate_limits": rate_limit_stats,
+        }
+
+    async def health(request):
+        return web.json_response({"status": "ok", **state()})
+
+    async def ready(request):
+        return web.json_response(state(), status=200 if startup_state["ready"] else 503)
+
+    async def metrics(request):
+        # Формат Prometheus
+        lines = ["# TYPE bot_rate_limit_requests_total counter"]
+        for result, counters in rate_limit_stats.items():
+            for category, count in counters.items():
+                lines.append(f'bot_rate_limit_requests_total{{category="{category}",result="{result}"}} {count}')
+        lines.append("# TYPE bot_rate_limit_buckets gauge")
+        lines.append(f"bot_rate_limit_buckets {len(rate_buckets)}")
+        return web.Response(text="\n".join(lines) + "\n")
+
+    app = web.Application()
+    app.router.add_get("/health", health)
+    app.router.add_get("/ready", ready)
+    app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, port=port).start()
+    logger.info(f"Health-эндпоинты слушают порт {port}")
 
 # --- ЗАПУСК ---
 async def main():
-    await bot.delete_webhook(drop_pending_updates=True)
-    await set_main_menu(bot)
+    global bot
+    if not BOT_TOKEN:
+        logger.error("BOT_TOKEN не найден в переменных окружения или .env файле!")
+        exit(1)
+    unknown_tiers = validate_rate_tiers()
+    if unknown_tiers:
+        logger.error(f"RATE_TIERS ссылается на неизвестные тарифы: {', '.join(unknown_tiers)}. Опишите их в RATE_LIMITS.")
+        exit(1)
+    bot = Bot(token=BOT_TOKEN)
+
+    file_cache.update(load_file_cache())
+    reset_temp_folder()
+    if HEALTH_PORT:
+        await start_health_server(int(HEALTH_PORT))
+
+    # Все, без чего можно принимать апдейты, выполняется в фоне - в отдельных потоках,
+    # а не в общем executor, чтобы долгий rmtree не занимал воркеры загрузок и поиска
+    for startup_job in (cleanup_stale_temp, ytmusic.get):
+        threading.Thread(target=startup_job, name=f"startup-{startup_job.__name__}", daemon=True).start()
+    catalog_executor.submit(get_catalog)
+    asyncio.create_task(set_main_menu(bot))
     asyncio.create_task(check_artist_updates())
+    asyncio.create_task(cache_warmer())
+
+    await bot.delete_webhook(drop_pending_updates=True)
     await dp.start_polling(bot)
 
 if __name__ == "__main__":